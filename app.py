@@ -1,16 +1,26 @@
 import streamlit as st
 from datetime import datetime
-import gspread
-import pandas as pd
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build  # Importación añadida
-from googleapiclient.http import MediaIoBaseUpload  # Importación añadida
 from dotenv import load_dotenv
 import os
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+import logging
+import math
+import re
+from collections import Counter, OrderedDict
+
+# gspread, pandas, google-auth y googleapiclient se importan recién cuando se usan:
+# la página de presentación no los necesita y así el arranque es más rápido.
+# verificar_arranque.py controla el tiempo de carga y que no se importen al arrancar.
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configuración de Google Sheets y Drive
 creds_info = {
     "type": os.getenv("TYPE"),
@@ -30,16 +40,376 @@ scope = [
     "https://www.googleapis.com/auth/drive"
 ]
 
-creds = Credentials.from_service_account_info(creds_info, scopes=scope)
-client = gspread.authorize(creds)
+@st.cache_resource
+def obtener_credenciales():
+    from google.oauth2.service_account import Credentials
+    return Credentials.from_service_account_info(creds_info, scopes=scope)
+
+@st.cache_resource
+def obtener_planilla():
+    """Autentica y abre la planilla la primera vez que se necesita"""
+    import gspread
+    try:
+        return gspread.authorize(obtener_credenciales()).open("HistorialesMedicos")
+    except gspread.exceptions.SpreadsheetNotFound:
+        st.error("No se encontró la hoja de cálculo. Verifica el nombre y los permisos.")
+        st.stop()
+
+@st.cache_resource
+def obtener_hoja(nombre):
+    return obtener_planilla().worksheet(nombre)
+
+def crear_servicio_drive(credenciales=None):
+    """Cliente de Drive construido con el documento de descubrimiento incluido en
+    googleapiclient (sin descargarlo de la red). No se comparte entre sesiones ni hilos:
+    el cliente HTTP de googleapiclient no es thread-safe, así que se crea uno por uso."""
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', credentials=credenciales or obtener_credenciales(),
+                 static_discovery=True, cache_discovery=False)
+
+# Journal local de escrituras (SQLite). Toda escritura se guarda primero acá y
+# después se reproduce en Sheets en orden, así no se pierde nada si Sheets falla.
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "journal_escrituras.db")
+# Espera entre reintentos cuando Sheets falla: se duplica en cada fallo hasta el máximo
+REINTENTO_JOURNAL_SEG = int(os.getenv("REINTENTO_JOURNAL_SEG", "10"))
+REINTENTO_JOURNAL_MAX_SEG = int(os.getenv("REINTENTO_JOURNAL_MAX_SEG", "300"))
+
+@st.cache_resource
+def inicializar_base():
+    """Crea las tablas de la base local (journal, snapshots, recomendaciones, analítica e
+    índice de resultados) una sola vez por proceso"""
+    conn = sqlite3.connect(JOURNAL_PATH, timeout=30)
+    try:
+        crear_esquema(conn)
+    finally:
+        conn.close()
+    return True
+
+def conectar_journal(sincronico="FULL"):
+    """Abre la base local; por defecto con fsync en cada commit"""
+    inicializar_base()
+    conn = sqlite3.connect(JOURNAL_PATH, timeout=30)
+    conn.execute(f"PRAGMA synchronous={sincronico}")
+    return conn
+
+def crear_esquema(conn):
+    # WAL queda grabado en el archivo, no hace falta repetirlo en cada conexión
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operacion TEXT NOT NULL,
+            dni TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            creado TEXT NOT NULL,
+            aplicado TEXT,
+            error TEXT
+        )""")
+    # Bases creadas antes de que existiera la columna de error
+    if "error" not in [columna[1] for columna in conn.execute("PRAGMA table_info(journal)")]:
+        conn.execute("ALTER TABLE journal ADD COLUMN error TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshots (
+            hoja TEXT PRIMARY KEY,
+            registros TEXT NOT NULL,
+            actualizado TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recomendaciones (
+            dni TEXT PRIMARY KEY,
+            datos TEXT NOT NULL,
+            respuestas TEXT NOT NULL,
+            intervenciones TEXT NOT NULL,
+            actualizado TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS huellas_reglas (
+            huella TEXT PRIMARY KEY,
+            cantidad INTEGER NOT NULL
+        )""")
+    # Tabla anterior, con huellas por nombre de intervención
+    conn.execute("DROP TABLE IF EXISTS reglas")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analitica (
+            clave TEXT PRIMARY KEY,
+            cantidad INTEGER NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS aportes_analitica (
+            dni TEXT PRIMARY KEY,
+            paciente TEXT NOT NULL,
+            intervenciones TEXT NOT NULL,
+            estudios TEXT NOT NULL,
+            claves TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS indice_resultados (
+            fila INTEGER PRIMARY KEY,
+            dni TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            institucion TEXT NOT NULL,
+            archivo TEXT NOT NULL
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_resultados_dni_fecha ON indice_resultados (dni, fecha DESC)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metadatos (
+            clave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL
+        )""")
+    conn.commit()
+
+@st.cache_resource
+def obtener_lock_journal():
+    """Lock compartido entre sesiones para que una sola reproduzca el journal"""
+    return threading.Lock()
+
+def registrar_escritura(operacion, dni, payload):
+    """Guarda una escritura en el journal antes de enviarla a Sheets"""
+    conn = conectar_journal()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO journal (operacion, dni, payload, creado) VALUES (?, ?, ?, ?)",
+                (operacion, str(dni), json.dumps(payload, default=str), datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+
+def escrituras_pendientes(operacion=None):
+    """Devuelve (dni, payload) de las escrituras que todavía no llegaron a Sheets"""
+    conn = conectar_journal()
+    try:
+        consulta = "SELECT dni, payload FROM journal WHERE aplicado IS NULL AND error IS NULL"
+        parametros = ()
+        if operacion:
+            consulta += " AND operacion = ?"
+            parametros = (operacion,)
+        return [(dni, json.loads(payload)) for dni, payload in conn.execute(consulta + " ORDER BY id", parametros)]
+    finally:
+        conn.close()
+
+def escrituras_apartadas():
+    """Escrituras que fallaron de forma permanente y no se van a reintentar"""
+    conn = conectar_journal()
+    try:
+        return conn.execute(
+            "SELECT id, operacion, dni, creado, error FROM journal "
+            "WHERE aplicado IS NULL AND error IS NOT NULL ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+def es_error_transitorio(error):
+    """Cuota, caídas de Sheets o red se reintentan; datos inválidos o fila inexistente no"""
+    codigo = getattr(getattr(error, "response", None), "status_code", None)
+    if codigo is not None:
+        return codigo not in (400, 404)
+    return not isinstance(error, (ValueError, KeyError, TypeError, IndexError))
+
+def registros_del_lote(lote, hoja):
+    """Snapshot de la hoja leído una sola vez por tanda de reproducción; cada escritura
+    de la tanda lo corrige en memoria y se guarda al terminar"""
+    if hoja.title not in lote:
+        lote[hoja.title] = refrescar_snapshot(hoja)
+    return lote[hoja.title]
+
+def aplicar_escritura(operacion, dni, payload, lote):
+    """Aplica una escritura del journal en Sheets. Es idempotente por DNI y fila,
+    así que reproducirla dos veces (por ejemplo tras un corte) no duplica datos."""
+    if operacion == "alta_paciente":
+        hoja = obtener_hoja("Pacientes")
+        registros = registros_del_lote(lote, hoja)
+        if find_dni_row(hoja, dni, registros) is None:
+            columnas = mapa_columnas(hoja, registros)
+            if isinstance(payload, dict):
+                # Ubicar cada campo según los encabezados actuales de la hoja
+                verificar_columnas(hoja, columnas, payload)
+                fila = [""] * max(columnas[campo] for campo in payload)
+                for campo, valor in payload.items():
+                    fila[columnas[campo] - 1] = valor
+                payload = fila
+            hoja.append_row(payload)
+            registros.append({nombre: payload[idx - 1] if idx <= len(payload) else ""
+                              for nombre, idx in columnas.items()})
+    elif operacion == "datos_medicos":
+        hoja = obtener_hoja("Pacientes")
+        registros = registros_del_lote(lote, hoja)
+        row = find_dni_row(hoja, dni, registros)
+        if not row:
+            raise ValueError(f"No se encontró la fila del DNI {dni}")
+        update_record(hoja, row, payload, registros)
+    elif operacion == "resultado":
+        hoja = obtener_hoja("Resultados")
+        registros = registros_del_lote(lote, hoja)
+        filas = [idx for idx, r in enumerate(registros, start=2) if str(r.get('Archivo', '')) == payload[5]]
+        if filas:
+            fila = filas[0]
+        else:
+            respuesta = hoja.append_row(payload)
+            # updatedRange viene como "Resultados!A15:G15"
+            fila = int(re.search(r"![A-Z]+(\d+)", respuesta['updates']['updatedRange']).group(1))
+            columnas = mapa_columnas(hoja, registros)
+            registros.append({nombre: payload[idx - 1] if idx <= len(payload) else ""
+                              for nombre, idx in columnas.items()})
+        indexar_resultado(fila, payload[0], payload[3], payload[4], payload[2], payload[5])
+    else:
+        raise ValueError(f"Operación de journal desconocida: {operacion}")
+
+def reproducir_journal():
+    """Envía a Sheets las escrituras pendientes en orden y devuelve cuántas quedan.
+    Ante un error transitorio se detiene para respetar el orden y reintentar más tarde;
+    un error permanente aparta la escritura (columna error) para no bloquear al resto."""
+    lock = obtener_lock_journal()
+    if not lock.acquire(blocking=False):
+        return len(escrituras_pendientes())
+    lote = {}
+    try:
+        conn = conectar_journal()
+        try:
+            pendientes = conn.execute(
+                "SELECT id, operacion, dni, payload FROM journal "
+                "WHERE aplicado IS NULL AND error IS NULL ORDER BY id"
+            ).fetchall()
+            for id_escritura, operacion, dni, payload in pendientes:
+                try:
+                    aplicar_escritura(operacion, dni, json.loads(payload), lote)
+                except Exception as e:
+                    if es_error_transitorio(e):
+                        logger.warning("Journal: escritura %s (%s) queda pendiente: %s", id_escritura, operacion, e)
+                        break
+                    logger.error("Journal: escritura %s (%s) apartada: %s", id_escritura, operacion, e)
+                    with conn:
+                        conn.execute("UPDATE journal SET error = ? WHERE id = ?", (str(e), id_escritura))
+                    continue
+                with conn:
+                    conn.execute(
+                        "UPDATE journal SET aplicado = ? WHERE id = ?",
+                        (datetime.now().isoformat(), id_escritura)
+                    )
+            return conn.execute(
+                "SELECT COUNT(*) FROM journal WHERE aplicado IS NULL AND error IS NULL"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+            for hoja, registros in lote.items():
+                guardar_snapshot(hoja, registros)
+    finally:
+        lock.release()
+
+def leer_metadato(clave, defecto=None):
+    conn = conectar_journal()
+    try:
+        fila = conn.execute("SELECT valor FROM metadatos WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else defecto
+    finally:
+        conn.close()
+
+def guardar_metadato(clave, valor):
+    conn = conectar_journal()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO metadatos (clave, valor) VALUES (?, ?)", (clave, str(valor)))
+    finally:
+        conn.close()
+
+@st.cache_resource
+def iniciar_reproductor_journal():
+    """Arranca una sola vez por proceso el hilo que reproduce el journal en Sheets.
+    Los reintentos usan espera exponencial y el próximo intento se guarda en metadatos."""
+    aviso = threading.Event()
+
+    def ciclo():
+        while True:
+            espera = float(leer_metadato("journal_proximo_intento", 0)) - time.time()
+            if espera > 0:
+                # En espera por errores de Sheets: no se reintenta antes aunque lleguen escrituras
+                time.sleep(espera)
+                continue
+            aviso.wait(timeout=REINTENTO_JOURNAL_MAX_SEG)
+            aviso.clear()
+            try:
+                pendientes = reproducir_journal()
+            except Exception as e:
+                logger.exception("Error reproduciendo el journal: %s", e)
+                pendientes = 1
+            if pendientes:
+                fallos = int(leer_metadato("journal_fallos", 0)) + 1
+                guardar_metadato("journal_fallos", fallos)
+                guardar_metadato(
+                    "journal_proximo_intento",
+                    time.time() + min(REINTENTO_JOURNAL_MAX_SEG, REINTENTO_JOURNAL_SEG * 2 ** (fallos - 1))
+                )
+                aviso.set()
+            else:
+                guardar_metadato("journal_fallos", 0)
+
+    # Primera pasada al arrancar el proceso, por si quedaron escrituras de una ejecución anterior
+    aviso.set()
+    threading.Thread(target=ciclo, name="reproductor_journal", daemon=True).start()
+    return aviso
+
+def avisar_reproductor_journal():
+    """Despierta al hilo del journal; la escritura del usuario no espera a Sheets"""
+    iniciar_reproductor_journal().set()
+
+@st.cache_resource
+def obtener_huellas_snapshots():
+    """Huella del último snapshot guardado por hoja en este proceso"""
+    return {}
+
+def guardar_snapshot(hoja, registros):
+    """Guarda el snapshot solo si el contenido cambió desde el último guardado. Un snapshot
+    se puede volver a leer de Sheets, así que no necesita fsync en cada commit."""
+    contenido = json.dumps(registros, default=str)
+    huella = hashlib.sha256(contenido.encode()).hexdigest()
+    huellas = obtener_huellas_snapshots()
+    if huellas.get(hoja) == huella:
+        return
+    conn = conectar_journal(sincronico="NORMAL")
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshots (hoja, registros, actualizado) VALUES (?, ?, ?)",
+                (hoja, contenido, datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+    huellas[hoja] = huella
+
+def leer_snapshot(hoja):
+    conn = conectar_journal()
+    try:
+        fila = conn.execute("SELECT registros FROM snapshots WHERE hoja = ?", (hoja,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+    finally:
+        conn.close()
+
+def refrescar_snapshot(sheet):
+    """Lee la hoja completa de Sheets y la guarda como último snapshot bueno"""
+    registros = sheet.get_all_records()
+    guardar_snapshot(sheet.title, registros)
+    return registros
+
+def leer_registros(nombre):
+    """Lee todos los registros de la hoja; si Sheets no responde (incluso al autenticar o
+    abrir la planilla en un proceso recién iniciado) usa el último snapshot bueno"""
+    try:
+        return refrescar_snapshot(obtener_hoja(nombre))
+    except Exception:
+        registros = leer_snapshot(nombre)
+        if registros is None:
+            raise
+        st.warning("Google Sheets no está disponible en este momento. Se muestran los últimos datos guardados.")
+        return registros
+
+def mapa_columnas(sheet, registros):
+    """Mapea cada nombre de campo a su número de columna según la fila de encabezados.
+    Los encabezados salen del snapshot (las claves de los registros), así que no hace
+    falta otra lectura; solo si la hoja está vacía se lee la fila 1."""
+    encabezados = list(registros[0].keys()) if registros else sheet.row_values(1)
+    return {nombre: idx for idx, nombre in enumerate(encabezados, start=1) if nombre}
 
-try:
-    sheet_pacientes = client.open("HistorialesMedicos").worksheet("Pacientes")
-    sheet_resultados = client.open("HistorialesMedicos").worksheet("Resultados")
-except gspread.exceptions.SpreadsheetNotFound:
-    st.error("No se encontró la hoja de cálculo. Verifica el nombre y los permisos.")
-    st.stop()
-    
 def calcular_imc(peso, altura):
     if altura == 0:
         return 0, ("Error", "", "red")
@@ -60,14 +430,20 @@ def calcular_imc(peso, altura):
         
         
 # Función para obtener intervenciones
-def obtener_intervenciones(datos_personales, respuestas_medicas):
+def cargar_reglas():
+    """Lee las reglas de la hoja Intervenciones (con snapshot si Sheets no responde)"""
+    return leer_registros("Intervenciones")
+
+def obtener_intervenciones(datos_personales, respuestas_medicas, reglas=None, mostrar_errores=True):
+    """Intervenciones que aplican al paciente. Devuelve None si las reglas no se pudieron
+    cargar o evaluar, para no confundirlo con un paciente sin recomendaciones."""
     try:
-        sheet = client.open("HistorialesMedicos").worksheet("Intervenciones")
-        registros = sheet.get_all_records()
+        registros = cargar_reglas() if reglas is None else reglas
         
         intervenciones = []
         for registro in registros:
-            if evaluar_criterios(registro['CRITERIO_APLICACION'], datos_personales, respuestas_medicas):
+            if evaluar_criterios(registro['CRITERIO_APLICACION'], datos_personales, respuestas_medicas,
+                                 mostrar_errores=mostrar_errores):
                 intervenciones.append({
                     'nombre': registro['INTERVENCIÓN'],
                     'categoria': registro['CATEGORIA'],
@@ -76,11 +452,12 @@ def obtener_intervenciones(datos_personales, respuestas_medicas):
                 })
         return intervenciones
     except Exception as e:
-        st.error(f"Error cargando intervenciones: {str(e)}")
-        return []
+        if mostrar_errores:
+            st.error(f"Error cargando intervenciones: {str(e)}")
+        return None
 
 # Función para evaluar criterios
-def evaluar_criterios(criterio_str, datos, respuestas):
+def evaluar_criterios(criterio_str, datos, respuestas, mostrar_errores=True):
     try:
         # Variables disponibles
         edad = respuestas.get('edad', 0)
@@ -105,13 +482,379 @@ def evaluar_criterios(criterio_str, datos, respuestas):
         
         return eval(criterio_eval)
     except Exception as e:
-        st.error(f"Error evaluando criterio: {criterio_str} - {str(e)}")
+        if mostrar_errores:
+            st.error(f"Error evaluando criterio: {criterio_str} - {str(e)}")
+        else:
+            logger.warning("Error evaluando criterio: %s - %s", criterio_str, e)
         return False
+
+# Recomendaciones materializadas por DNI. Se calculan al enviar el cuestionario y
+# un hilo en segundo plano recalcula solo los pacientes afectados cuando cambian las reglas.
+INTERVALO_RECALCULO = int(os.getenv("INTERVALO_RECALCULO", "300"))
+
+def guardar_recomendaciones(dni, datos_personales, respuestas_medicas, intervenciones):
+    """Guarda las intervenciones del paciente junto con los datos que las originaron"""
+    conn = conectar_journal()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO recomendaciones (dni, datos, respuestas, intervenciones, actualizado) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(dni), json.dumps(datos_personales, default=str), json.dumps(respuestas_medicas, default=str),
+                 json.dumps(intervenciones), datetime.now().isoformat())
+            )
+    finally:
+        conn.close()
+
+def leer_recomendaciones(dni):
+    """Lectura por DNI de las recomendaciones materializadas; None si todavía no existen"""
+    conn = conectar_journal()
+    try:
+        fila = conn.execute(
+            "SELECT datos, respuestas, intervenciones, actualizado FROM recomendaciones WHERE dni = ?",
+            (str(dni),)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not fila:
+        return None
+    return {
+        'datos_personales': json.loads(fila[0]),
+        'respuestas_medicas': json.loads(fila[1]),
+        'intervenciones': json.loads(fila[2]),
+        'actualizado': fila[3]
+    }
+
+def materializar_recomendaciones(dni, datos_personales, respuestas_medicas):
+    """Calcula y guarda las recomendaciones del paciente; devuelve las intervenciones
+    o None si las reglas no se pudieron cargar. Usa el snapshot de reglas (lo mantiene al
+    día el hilo de recálculo) y solo lee Sheets si todavía no hay ninguno."""
+    try:
+        reglas = leer_snapshot("Intervenciones")
+        if reglas is None:
+            reglas = cargar_reglas()
+    except Exception as e:
+        st.error(f"Error cargando intervenciones: {str(e)}")
+        return None
+    intervenciones = obtener_intervenciones(datos_personales, respuestas_medicas, reglas=reglas)
+    if intervenciones is None:
+        return None
+    guardar_recomendaciones(dni, datos_personales, respuestas_medicas, intervenciones)
+    actualizar_analitica(dni, intervenciones=intervenciones)
+    iniciar_recalculo_recomendaciones()
+    return intervenciones
+
+def perfil_desde_paciente(paciente):
+    """Arma (datos_personales, respuestas_medicas) a partir de una fila de la hoja Pacientes"""
+    datos_personales = {
+        'Sexo_Biologico': paciente.get('Sexo_Biologico', ''),
+        'Nombre': paciente.get('Nombre', ''),
+        'Apellido': paciente.get('Apellido', '')
+    }
+    
+    respuestas_medicas = {
+        'edad': paciente.get('Edad', 0),
+        'imc_val': float(paciente.get('IMC_val', 0) or 0),
+        'condiciones': {
+            'hipertension': paciente.get('Hipertension', 'No'),
+            'diabetes': paciente.get('Diabetes', 'No'),
+            'colesterol': paciente.get('Colesterol', 'No'),
+            'sedentarismo': paciente.get('Sedentarismo', 'No'),
+            'tiempo_sentado': paciente.get('Tiempo_sentado', 'No'),
+            'fumador': paciente.get('Fumador', 'No'),
+            'fumador_20_anios': paciente.get('Fumador_20_anios', 'No'),
+            'antecedentes_mama': paciente.get('Antecedentes_mama', 'No')
+        }
+    }
+    return datos_personales, respuestas_medicas
+
+def recalcular_recomendaciones():
+    """Recalcula solo los pacientes afectados por reglas nuevas, editadas o borradas.
+    Devuelve la cantidad de pacientes actualizados."""
+    reglas = obtener_hoja("Intervenciones").get_all_records()
+    guardar_snapshot("Intervenciones", reglas)
+    # La huella es el contenido completo de la fila: puede haber varias filas con la
+    # misma INTERVENCIÓN (por ejemplo un criterio por sexo o por edad)
+    actuales = Counter(json.dumps(regla, sort_keys=True, default=str) for regla in reglas)
+
+    conn = conectar_journal()
+    try:
+        anteriores = Counter(dict(conn.execute("SELECT huella, cantidad FROM huellas_reglas")))
+        huellas_cambiadas = {huella for huella in actuales.keys() | anteriores.keys()
+                             if actuales[huella] != anteriores[huella]}
+        if not huellas_cambiadas:
+            return 0
+
+        # Nombres de las filas agregadas, editadas (versión vieja y nueva) o borradas
+        cambiadas = {json.loads(huella).get('INTERVENCIÓN') for huella in huellas_cambiadas}
+        reglas_cambiadas = [regla for regla in reglas
+                            if json.dumps(regla, sort_keys=True, default=str) in huellas_cambiadas]
+        actualizados = 0
+        pacientes = conn.execute(
+            "SELECT dni, datos, respuestas, intervenciones, actualizado FROM recomendaciones"
+        ).fetchall()
+        for dni, datos, respuestas, intervenciones, actualizado in pacientes:
+            datos, respuestas = json.loads(datos), json.loads(respuestas)
+            # Afectado: tenía una intervención cambiada o ahora le aplica alguna regla cambiada
+            previas = {i['nombre'] for i in json.loads(intervenciones)}
+            if not previas & cambiadas and not obtener_intervenciones(
+                    datos, respuestas, reglas=reglas_cambiadas, mostrar_errores=False):
+                continue
+            nuevas = obtener_intervenciones(datos, respuestas, reglas=reglas, mostrar_errores=False)
+            if nuevas is None:
+                continue
+            # Solo si nadie la materializó mientras tanto (por ejemplo el paciente
+            # reenviando el formulario); si no, se pisaría un perfil más nuevo
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE recomendaciones SET intervenciones = ?, actualizado = ? WHERE dni = ? AND actualizado = ?",
+                    (json.dumps(nuevas), datetime.now().isoformat(), dni, actualizado)
+                )
+            if not cursor.rowcount:
+                continue
+            actualizar_analitica(dni, intervenciones=nuevas)
+            actualizados += 1
+
+        with conn:
+            conn.execute("DELETE FROM huellas_reglas")
+            conn.executemany("INSERT INTO huellas_reglas (huella, cantidad) VALUES (?, ?)", actuales.items())
+        return actualizados
+    finally:
+        conn.close()
+
+@st.cache_resource
+def iniciar_recalculo_recomendaciones():
+    """Arranca una sola vez por proceso el hilo que propaga los cambios de reglas.
+    Se llama recién al materializar recomendaciones o al entrar a las páginas que las
+    usan, para no autenticar ni importar gspread al servir la presentación."""
+    def ciclo():
+        while True:
+            try:
+                actualizados = recalcular_recomendaciones()
+                if actualizados:
+                    logger.info("Recomendaciones recalculadas para %s pacientes", actualizados)
+            except Exception as e:
+                logger.warning("Error recalculando recomendaciones: %s", e)
+            time.sleep(INTERVALO_RECALCULO)
+
+    hilo = threading.Thread(target=ciclo, name="recalculo_recomendaciones", daemon=True)
+    hilo.start()
+    return hilo
+
+
+# Analítica poblacional. Cada paciente aporta un conjunto de claves (categoría de IMC,
+# factores de riesgo por banda etaria y sexo, intervenciones pendientes por categoría);
+# en cada escritura se resta su aporte anterior y se suma el nuevo, sin recorrer al resto.
+FACTORES_RIESGO = ['Hipertension', 'Diabetes', 'Colesterol', 'Sedentarismo', 'Fumador',
+                   'Alcohol_drogas', 'Depresion']
+BANDAS_ETARIAS = ["Menos de 30", "30-44", "45-59", "60-74", "75 o más", "Sin dato"]
+
+@st.cache_resource
+def obtener_lock_analitica():
+    return threading.Lock()
+
+def banda_etaria(paciente):
+    edad = paciente.get('Edad', '')
+    if edad in ('', None) and paciente.get('Fecha_Nacimiento'):
+        try:
+            fecha_nac = datetime.strptime(str(paciente['Fecha_Nacimiento']), "%Y-%m-%d")
+            edad = datetime.now().year - fecha_nac.year
+        except ValueError:
+            edad = ''
+    try:
+        edad = int(float(edad))
+    except (TypeError, ValueError):
+        return "Sin dato"
+    for limite, banda in zip([30, 45, 60, 75], BANDAS_ETARIAS):
+        if edad < limite:
+            return banda
+    return "75 o más"
+
+def claves_analiticas(paciente, intervenciones, estudios):
+    """Claves de agregado que aporta un paciente (puede repetir claves)"""
+    claves = ["registrados"]
+    if not paciente.get('IMC_cat'):
+        return claves
+    grupo = f"{banda_etaria(paciente)}|{paciente.get('Sexo_Biologico') or 'Sin dato'}"
+    claves.append(f"evaluados|{grupo}")
+    claves.append(f"imc|{paciente['IMC_cat']}")
+    claves += [f"factor|{factor}|{grupo}" for factor in FACTORES_RIESGO if paciente.get(factor) == "Sí"]
+    claves += [f"pendiente|{i['categoria']}" for i in intervenciones if i['tipo_estudio'] not in estudios]
+    return claves
+
+def actualizar_analitica(dni, paciente=None, intervenciones=None, estudio=None):
+    """Actualiza los agregados con el aporte nuevo del paciente (resta el anterior y suma el nuevo).
+    Los argumentos omitidos conservan el último valor guardado para ese DNI. Toma el mismo
+    lock que la carga inicial para no escribir en medio de la reconstrucción."""
+    with obtener_lock_analitica():
+        conn = conectar_journal()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                fila = conn.execute(
+                    "SELECT paciente, intervenciones, estudios, claves FROM aportes_analitica WHERE dni = ?",
+                    (str(dni),)
+                ).fetchone()
+                previo, previas, estudios, claves_previas = (json.loads(valor) for valor in fila) if fila else ({}, [], [], [])
+                paciente = {**previo, **(paciente or {})}
+                intervenciones = previas if intervenciones is None else intervenciones
+                if estudio and estudio not in estudios:
+                    estudios.append(estudio)
+                claves = claves_analiticas(paciente, intervenciones, estudios)
+
+                delta = Counter(claves)
+                delta.subtract(Counter(claves_previas))
+                conn.executemany(
+                    "INSERT INTO analitica (clave, cantidad) VALUES (?, ?) "
+                    "ON CONFLICT(clave) DO UPDATE SET cantidad = cantidad + excluded.cantidad",
+                    [(clave, cantidad) for clave, cantidad in delta.items() if cantidad]
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO aportes_analitica (dni, paciente, intervenciones, estudios, claves) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (str(dni), json.dumps(paciente, default=str), json.dumps(intervenciones),
+                     json.dumps(estudios), json.dumps(claves))
+                )
+        except Exception as e:
+            # La analítica no debe impedir guardar los datos del paciente
+            logger.exception("Error actualizando analítica del DNI %s: %s", dni, e)
+        finally:
+            conn.close()
+
+def inicializar_analitica():
+    """Carga inicial de los agregados a partir de las planillas (una sola vez).
+    Lee las recomendaciones guardadas en una sola consulta y escribe todo en una transacción.
+    Las escrituras del journal que todavía no llegaron a Sheets se suman a lo leído: si no,
+    la reconstrucción borraría su aporte y la diferencia quedaría para siempre. Mientras
+    dura, actualizar_analitica espera el lock."""
+    with obtener_lock_analitica():
+        conn = conectar_journal()
+        try:
+            if conn.execute("SELECT 1 FROM analitica WHERE clave = 'inicializado'").fetchone():
+                return
+            guardadas = {dni: json.loads(intervenciones) for dni, intervenciones
+                         in conn.execute("SELECT dni, intervenciones FROM recomendaciones")}
+        finally:
+            conn.close()
+
+        pacientes = {str(paciente.get('DNI', '')): paciente for paciente in leer_registros("Pacientes")}
+        for operacion in ("alta_paciente", "datos_medicos"):
+            for dni, payload in escrituras_pendientes(operacion):
+                if isinstance(payload, dict):
+                    pacientes[str(dni)] = {**pacientes.get(str(dni), {'DNI': dni}), **payload}
+        estudios = {}
+        for resultado in leer_registros("Resultados"):
+            estudios.setdefault(str(resultado.get('DNI', '')), set()).add(resultado.get('Tipo_Estudio', ''))
+        for dni, payload in escrituras_pendientes("resultado"):
+            estudios.setdefault(str(dni), set()).add(payload[4])
+        reglas = cargar_reglas()
+
+        totales = Counter()
+        aportes = []
+        nuevas_recomendaciones = []
+        ahora = datetime.now().isoformat()
+        for dni, paciente in pacientes.items():
+            if dni in guardadas:
+                intervenciones = guardadas[dni]
+            elif paciente.get('IMC_cat'):
+                datos_personales, respuestas_medicas = perfil_desde_paciente(paciente)
+                intervenciones = obtener_intervenciones(datos_personales, respuestas_medicas,
+                                                        reglas=reglas, mostrar_errores=False)
+                if intervenciones is None:
+                    # Reglas con error: no se guarda un "sin recomendaciones" para el paciente
+                    intervenciones = []
+                else:
+                    nuevas_recomendaciones.append((dni, json.dumps(datos_personales, default=str),
+                                                   json.dumps(respuestas_medicas, default=str),
+                                                   json.dumps(intervenciones), ahora))
+            else:
+                intervenciones = []
+            estudios_paciente = sorted(estudios.get(dni, ()))
+            claves = claves_analiticas(paciente, intervenciones, estudios_paciente)
+            totales.update(claves)
+            aportes.append((dni, json.dumps(paciente, default=str), json.dumps(intervenciones),
+                            json.dumps(estudios_paciente), json.dumps(claves)))
+
+        conn = conectar_journal()
+        try:
+            with conn:
+                # OR IGNORE: no pisar las que se materializaron mientras se leía Sheets
+                conn.executemany(
+                    "INSERT OR IGNORE INTO recomendaciones (dni, datos, respuestas, intervenciones, actualizado) "
+                    "VALUES (?, ?, ?, ?, ?)", nuevas_recomendaciones
+                )
+                conn.execute("DELETE FROM analitica")
+                conn.execute("DELETE FROM aportes_analitica")
+                conn.executemany("INSERT INTO analitica (clave, cantidad) VALUES (?, ?)", totales.items())
+                conn.executemany(
+                    "INSERT OR REPLACE INTO aportes_analitica (dni, paciente, intervenciones, estudios, claves) "
+                    "VALUES (?, ?, ?, ?, ?)", aportes
+                )
+                conn.execute("INSERT INTO analitica (clave, cantidad) VALUES ('inicializado', 1)")
+        finally:
+            conn.close()
+
+def mostrar_panel_analitica():
+    try:
+        inicializar_analitica()
+    except Exception as e:
+        st.error(f"Error cargando la analítica: {str(e)}")
+        return
+
+    conn = conectar_journal()
+    try:
+        agregados = dict(conn.execute("SELECT clave, cantidad FROM analitica WHERE cantidad > 0"))
+    finally:
+        conn.close()
+
+    if not agregados.get('registrados'):
+        st.info("Todavía no hay pacientes registrados.")
+        return
+
+    import pandas as pd
+
+    evaluados = {clave: n for clave, n in agregados.items() if clave.startswith("evaluados|")}
+    col1, col2 = st.columns(2)
+    col1.metric("Pacientes registrados", agregados['registrados'])
+    col2.metric("Con cuestionario completo", sum(evaluados.values()))
+
+    st.subheader("Distribución por categoría de IMC")
+    imc = {clave.split("|", 1)[1]: n for clave, n in agregados.items() if clave.startswith("imc|")}
+    if imc:
+        st.bar_chart(pd.Series(imc, name="Pacientes"))
+
+    st.subheader("Prevalencia de factores de riesgo (%) por edad y sexo")
+    filas = []
+    for clave, n in evaluados.items():
+        _, banda, sexo = clave.split("|")
+        fila = {'Edad': banda, 'Sexo': sexo, 'Evaluados': n}
+        for factor in FACTORES_RIESGO:
+            fila[factor] = round(100 * agregados.get(f"factor|{factor}|{banda}|{sexo}", 0) / n, 1)
+        filas.append(fila)
+    if filas:
+        filas.sort(key=lambda f: (BANDAS_ETARIAS.index(f['Edad']), f['Sexo']))
+        st.dataframe(pd.DataFrame(filas), hide_index=True, use_container_width=True)
+
+    st.subheader("Intervenciones pendientes por categoría")
+    pendientes = {clave.split("|", 1)[1]: n for clave, n in agregados.items() if clave.startswith("pendiente|")}
+    if pendientes:
+        st.bar_chart(pd.Series(pendientes, name="Intervenciones"))
+    else:
+        st.success("No hay intervenciones pendientes.")
+
     #Función para mostrar recomendaciones
 def mostrar_recomendaciones():
     datos = st.session_state.datos_personales
     respuestas = st.session_state.respuestas_medicas
-    intervenciones = obtener_intervenciones(datos, respuestas)
+    registro = leer_recomendaciones(datos.get('DNI', ''))
+    if registro:
+        intervenciones = registro['intervenciones']
+    else:
+        intervenciones = obtener_intervenciones(datos, respuestas)
+    if intervenciones is None:
+        # Sin reglas no se puede decir que el paciente no tenga recomendaciones
+        st.error("No se pudieron calcular las recomendaciones en este momento. Intente nuevamente en unos minutos.")
+        return
     
     st.markdown(f"""
     ## {datos['Nombre']}, estas son tus recomendaciones preventivas 💡
@@ -146,6 +889,7 @@ def mostrar_recomendaciones():
     # Tabla resumen
     if intervenciones:
         st.subheader("📋 Resumen completo")
+        import pandas as pd
         df = pd.DataFrame([{
             'Recomendación': i['nombre'],
             'Categoría': i['categoria'],
@@ -159,7 +903,7 @@ def mostrar_recomendaciones():
 # Función para obtener instituciones
 def obtener_instituciones(tipo_estudio):
     try:
-        sheet = client.open("HistorialesMedicos").worksheet("Configuraciones")
+        sheet = obtener_hoja("Configuraciones")
         registros = sheet.get_all_records()
         return [row['Instituciones'] for row in registros if row['TiposEstudios'] == tipo_estudio]
     except Exception as e:
@@ -169,7 +913,9 @@ def obtener_instituciones(tipo_estudio):
 
 def verificar_dni_existente(dni):
     try:
-        registros = sheet_pacientes.get_all_records()
+        if any(str(dni_pendiente) == str(dni) for dni_pendiente, _ in escrituras_pendientes("alta_paciente")):
+            return True
+        registros = leer_registros("Pacientes")
         return any(str(paciente['DNI']) == str(dni) for paciente in registros)
     except Exception as e:
         st.error(f"Error al acceder a la base de datos: {e}")
@@ -186,7 +932,7 @@ def cargar_resultados():
     dni = datos['DNI']
     
     try:
-        sheet_config = client.open("HistorialesMedicos").worksheet("Configuraciones")
+        sheet_config = obtener_hoja("Configuraciones")
         instituciones = sheet_config.col_values(1)[1:]
         tipos_estudio = sheet_config.col_values(2)[1:]
     except Exception as e:
@@ -206,7 +952,8 @@ def cargar_resultados():
                 st.error("Complete todos los campos obligatorios")
             else:
                 try:
-                    drive_service = build('drive', 'v3', credentials=creds)
+                    from googleapiclient.http import MediaIoBaseUpload
+                    drive_service = crear_servicio_drive()
                     
                     file_metadata = {
                         'name': f"{dni}_{tipo_estudio}_{fecha_estudio}.pdf",
@@ -224,7 +971,7 @@ def cargar_resultados():
                     
                     enlace_archivo = f"https://drive.google.com/file/d/{uploaded_file['id']}/preview"
                     
-                    sheet_resultados.append_row([
+                    registrar_escritura("resultado", dni, [
                         dni,
                         profesional,
                         institucion,
@@ -233,7 +980,9 @@ def cargar_resultados():
                         enlace_archivo,
                         comentarios
                     ])
-                    
+
+                    actualizar_analitica(dni, estudio=tipo_estudio)
+                    avisar_reproductor_journal()
                     st.success("Resultado guardado exitosamente!")
                     st.session_state.mostrar_formulario_resultados = False
                 except Exception as e:
@@ -244,48 +993,11 @@ def cargar_resultados():
             st.session_state.mostrar_formulario_resultados = False
             st.rerun()
 
-def update_record(sheet, row, datos_medicos):
-    try:
-        column_map = {
-            'Edad': 'J',
-            'Peso': 'K',
-            'Altura': 'L',
-            'IMC_val': 'M',
-            'IMC_cat': 'N',
-            'Hipertension': 'O',
-            'Diabetes': 'P',
-            'Colesterol': 'Q',
-            'Sedentarismo': 'R',
-            'Tiempo_sentado': 'S',
-            'Fumador': 'T',
-            'Alcohol_drogas': 'U',
-            'Violencia_familiar': 'V',
-            'Depresion': 'W',
-            'Antecedentes_colon': 'X',
-            'Antecedentes_mama': 'Y',
-            'Antecedentes_cuello_utero': 'Z',
-            'Otro_cancer': 'AA',
-            'Otra_condicion': 'AB',
-            'Fumador_20_anios': 'AC',
-            'Embarazo_planeado': 'AD'
-        }
-        
-        values = [str(datos_medicos.get(col, "")) for col in column_map.keys()]
-        
-        sheet.update(
-            values=[values],
-            range_name=f"J{row}:AD{row}",
-            value_input_option="USER_ENTERED"
-        )
-        return True
-    except Exception as e:
-        st.error(f"Error actualizando registro: {str(e)}")
-        return False
-
-def find_dni_row(sheet, dni):
+def find_dni_row(sheet, dni, records=None):
     """Busca DNI ignorando formatos y espacios"""
     try:
-        records = sheet.get_all_records()
+        if records is None:
+            records = leer_registros(sheet.title)
         for idx, record in enumerate(records, start=2):
             # Normalizar ambos DNIs (eliminar espacios y caracteres no numéricos)
             sheet_dni = str(record.get('DNI', '')).strip().replace(' ', '').replace('-', '')
@@ -298,48 +1010,46 @@ def find_dni_row(sheet, dni):
         st.error(f"Error buscando DNI: {str(e)}")
         return None
     
-def update_record(sheet, row, datos_medicos):
-    """Actualiza los datos médicos en la fila especificada"""
-    try:
-        # Mapeo de columnas CORREGIDO (nombres exactos)
-        column_map = {
-            'Edad': 'J',
-            'Peso': 'K',
-            'Altura': 'L',
-            'IMC_val': 'M',
-            'IMC_cat': 'N',
-            'Hipertension': 'O',
-            'Diabetes': 'P',
-            'Colesterol': 'Q',
-            'Sedentarismo': 'R',
-            'Tiempo_sentado': 'S',
-            'Fumador': 'T',
-            'Alcohol_drogas': 'U',
-            'Violencia_familiar': 'V',
-            'Depresion': 'W',
-            'Antecedentes_colon': 'X',
-            'Antecedentes_mama': 'Y',
-            'Antecedentes_cuello_utero': 'Z',  # Guión bajo
-            'Otro_cancer': 'AA',
-            'Otra_condicion': 'AB',
-            'Fumador_20_anios': 'AC',
-            'Embarazo_planeado': 'AD'
-        }
-    
-        # Crear lista de valores en el orden correcto
-        values = [str(datos_medicos.get(col, "")) for col in column_map.keys()]
-        
-        # Actualizar usando nueva sintaxis (values first)
-        sheet.update(
-            values=[values],  # Lista 2D requerida
-            range_name=f"J{row}:AD{row}",  # Rango actualizado
-            value_input_option="USER_ENTERED"
-        )
+def valores_iguales(actual, nuevo):
+    """Compara un valor de la hoja con uno nuevo, tolerando 70 vs 70.0"""
+    try:
+        return float(actual) == float(nuevo)
+    except (TypeError, ValueError):
+        return str(actual).strip() == str(nuevo).strip()
+
+def verificar_columnas(sheet, columnas, datos):
+    """Falla si algún campo no tiene encabezado en la hoja. Es un error permanente: el
+    journal aparta la escritura (y la lista en la página de profesionales) en lugar de
+    perder esos datos sin aviso."""
+    faltantes = [campo for campo in datos if campo not in columnas]
+    if faltantes:
+        raise ValueError(f"La hoja {sheet.title} no tiene columnas para: {', '.join(faltantes)}")
+
+def update_record(sheet, row, datos_medicos, registros=None):
+    """Actualiza en la fila solo los campos que cambiaron, en un único batch_update.
+    Los errores se propagan para que el journal distinga los transitorios de los permanentes."""
+    from gspread.utils import rowcol_to_a1
+
+    if registros is None:
+        registros = refrescar_snapshot(sheet)
+    columnas = mapa_columnas(sheet, registros)
+    verificar_columnas(sheet, columnas, datos_medicos)
+
+    # Fila cacheada en el snapshot (la fila 1 son los encabezados)
+    actual = registros[row - 2] if 0 <= row - 2 < len(registros) else {}
+    cambios = {campo: valor for campo, valor in datos_medicos.items()
+               if campo not in actual or not valores_iguales(actual[campo], valor)}
+    if not cambios:
         return True
-        
-    except Exception as e:
-        st.error(f"Error actualizando registro: {str(e)}")
-        return False
+
+    sheet.batch_update(
+        [{'range': rowcol_to_a1(row, columnas[campo]), 'values': [[str(valor)]]}
+         for campo, valor in cambios.items()],
+        value_input_option="USER_ENTERED"
+    )
+    # Se corrige el snapshot en memoria; quien lo pasó (la tanda del journal) lo guarda
+    actual.update(cambios)
+    return True
     
     
 def mostrar_presentacion():
@@ -376,7 +1086,7 @@ def mostrar_presentacion():
 def buscar_paciente_por_dni(dni):
     """Busca un paciente por DNI y devuelve sus datos médicos"""
     try:
-        registros = sheet_pacientes.get_all_records()
+        registros = leer_registros("Pacientes")
         for paciente in registros:
             if str(paciente['DNI']) == str(dni):
                 return paciente
@@ -387,6 +1097,17 @@ def buscar_paciente_por_dni(dni):
 
 def pagina_profesionales():
     st.header("👩‍⚕️ Página para Profesionales")
+    iniciar_recalculo_recomendaciones()
+
+    # Escrituras que el journal apartó por errores permanentes (no se reintentan solas)
+    apartadas = escrituras_apartadas()
+    if apartadas:
+        with st.expander(f"⚠️ {len(apartadas)} escrituras no se pudieron guardar en la planilla"):
+            for id_escritura, operacion, dni_apartado, creado, error in apartadas:
+                st.write(f"**#{id_escritura}** {operacion} · DNI {dni_apartado} · {creado[:16]}  \n{error}")
+
+    if st.toggle("📊 Ver panel de salud poblacional", key="ver_panel_analitica"):
+        mostrar_panel_analitica()
     
     # Buscar paciente por DNI
     dni = st.text_input("Ingrese el DNI del paciente para buscar su historial", max_chars=8, key="input_dni").strip()
@@ -414,40 +1135,308 @@ def pagina_profesionales():
         if 'dni_paciente' not in st.session_state:
             st.warning("Primero busque un paciente por DNI.")
         else:
-            resultados = buscar_resultados_paciente(st.session_state.dni_paciente)
-            if resultados:
-                st.subheader("Resultados del paciente")
-                for resultado in resultados:
-                    st.write(f"**Profesional:** {resultado['profesional']}")
-                    st.write(f"**Institución:** {resultado['institucion']}")
-                    st.write(f"**Fecha del estudio:** {resultado['fecha_estudio']}")
-                    st.write(f"**Tipo de estudio:** {resultado['tipo_estudio']}")
-                    st.write(f"**Archivo:** [Abrir PDF]({resultado['archivo']})")  # Mostrar enlace al PDF
-                    st.write(f"**Comentarios:** {resultado['comentarios']}")
-                    st.write("---")
-            else:
-                st.warning("No se encontraron resultados para este paciente.")                
-def buscar_resultados_paciente(dni):
-    """Busca los resultados del paciente en la hoja Resultados"""
+            st.session_state.ver_resultados = True
+
+    # Queda visible entre reruns para poder paginar y filtrar
+    if st.session_state.get('ver_resultados') and 'dni_paciente' in st.session_state:
+        st.subheader("Resultados del paciente")
+        dni_paciente = st.session_state.dni_paciente
+        if not explorador_resultados(dni_paciente, f"resultados_profesional_{dni_paciente}"):
+            st.warning("No se encontraron resultados para este paciente.")
+
+# Explorador de resultados. Un índice local por DNI ordenado por Fecha_Estudio permite
+# traer de Sheets solo las filas de la página pedida; los metadatos de Drive de la
+# página siguiente se precargan en segundo plano.
+INTERVALO_INDICE_RESULTADOS = int(os.getenv("INTERVALO_INDICE_RESULTADOS", "600"))
+RESULTADOS_POR_PAGINA = [5, 10, 20]
+# Metadatos de Drive en memoria: como máximo MAX_METADATOS_DRIVE archivos (se descartan los
+# menos usados) y cada uno se vuelve a consultar pasados VIGENCIA_METADATOS_DRIVE segundos
+MAX_METADATOS_DRIVE = int(os.getenv("MAX_METADATOS_DRIVE", "1000"))
+VIGENCIA_METADATOS_DRIVE = int(os.getenv("VIGENCIA_METADATOS_DRIVE", "3600"))
+
+def normalizar_fecha(valor):
+    """Lleva la fecha a AAAA-MM-DD para poder ordenar; si no la reconoce la deja como está"""
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y"):
+        try:
+            return datetime.strptime(str(valor).strip(), formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return str(valor)
+
+def indexar_resultado(fila, dni, fecha, tipo, institucion, archivo):
+    conn = conectar_journal()
     try:
-        registros = sheet_resultados.get_all_records()
-        resultados = []
-        for registro in registros:
-            if str(registro['DNI']) == str(dni):  # Buscar por DNI
-                resultados.append({
-                    'profesional': registro.get('Profesional', ''),
-                    'institucion': registro.get('Institucion', ''),
-                    'fecha_estudio': registro.get('Fecha_Estudio', ''),
-                    'tipo_estudio': registro.get('Tipo_Estudio', ''),
-                    'archivo': registro.get('Archivo', ''),
-                    'comentarios': registro.get('Comentarios', '')
-                })
-        return resultados
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO indice_resultados (fila, dni, fecha, tipo, institucion, archivo) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (fila, str(dni), normalizar_fecha(fecha), str(tipo), str(institucion), str(archivo))
+            )
+    finally:
+        conn.close()
+
+def indice_resultados_al_dia(hoja, ultima_fila):
+    """Control barato de que la hoja no cambió de largo desde que se armó el índice:
+    la última fila indexada debe existir y la siguiente estar vacía. Así se detectan
+    altas hechas por otro proceso o réplica y filas borradas."""
+    try:
+        valores = hoja.get(f"A{ultima_fila}:A{ultima_fila + 1}")
+    except Exception as e:
+        logger.warning("No se pudo verificar el índice de resultados: %s", e)
+        return True
+    return len(valores) == 1
+
+def invalidar_indice_resultados():
+    """Fuerza la reconstrucción del índice en la próxima consulta"""
+    conn = conectar_journal()
+    try:
+        with conn:
+            conn.execute("DELETE FROM metadatos WHERE clave = 'indice_resultados'")
+    finally:
+        conn.close()
+
+def sincronizar_indice_resultados():
+    """Reconstruye el índice desde la hoja Resultados si pasó INTERVALO_INDICE_RESULTADOS,
+    si fue invalidado o si la hoja cambió de largo. Entre reconstrucciones, las altas de
+    este proceso se indexan al reproducir el journal."""
+    conn = conectar_journal()
+    try:
+        fila = conn.execute("SELECT valor FROM metadatos WHERE clave = 'indice_resultados'").fetchone()
+        ultima_fila = conn.execute("SELECT MAX(fila) FROM indice_resultados").fetchone()[0] or 1
+    finally:
+        conn.close()
+    if fila and time.time() - float(fila[0]) < INTERVALO_INDICE_RESULTADOS:
+        try:
+            if indice_resultados_al_dia(obtener_hoja("Resultados"), ultima_fila):
+                return
+        except Exception as e:
+            # Sin Sheets no se puede comprobar la hoja: se sigue con el índice que hay
+            logger.warning("No se pudo verificar el índice de resultados: %s", e)
+            return
+
+    registros = leer_registros("Resultados")
+    conn = conectar_journal()
+    try:
+        with conn:
+            conn.execute("DELETE FROM indice_resultados")
+            conn.executemany(
+                "INSERT INTO indice_resultados (fila, dni, fecha, tipo, institucion, archivo) VALUES (?, ?, ?, ?, ?, ?)",
+                [(idx, str(r.get('DNI', '')), normalizar_fecha(r.get('Fecha_Estudio', '')),
+                  str(r.get('Tipo_Estudio', '')), str(r.get('Institucion', '')), str(r.get('Archivo', '')))
+                 for idx, r in enumerate(registros, start=2)]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO metadatos (clave, valor) VALUES ('indice_resultados', ?)",
+                (str(time.time()),)
+            )
+    finally:
+        conn.close()
+
+def filtro_indice_resultados(dni, tipo=None, institucion=None):
+    consulta = "FROM indice_resultados WHERE dni = ?"
+    parametros = [str(dni)]
+    if tipo:
+        consulta += " AND tipo = ?"
+        parametros.append(tipo)
+    if institucion:
+        consulta += " AND institucion = ?"
+        parametros.append(institucion)
+    return consulta, parametros
+
+def contar_resultados_indice(dni, tipo=None, institucion=None):
+    """Cantidad de resultados del DNI en el índice con los filtros dados"""
+    consulta, parametros = filtro_indice_resultados(dni, tipo, institucion)
+    conn = conectar_journal()
+    try:
+        return conn.execute(f"SELECT COUNT(*) {consulta}", parametros).fetchone()[0]
+    finally:
+        conn.close()
+
+def pagina_resultados_indice(dni, tipo, institucion, limite, desde=0):
+    """(fila, archivo) de una página del índice para el DNI, de la más reciente a la más antigua"""
+    consulta, parametros = filtro_indice_resultados(dni, tipo, institucion)
+    conn = conectar_journal()
+    try:
+        return conn.execute(
+            f"SELECT fila, archivo {consulta} ORDER BY fecha DESC, fila DESC LIMIT ? OFFSET ?",
+            parametros + [limite, desde]
+        ).fetchall()
+    finally:
+        conn.close()
+
+def opciones_filtro_resultados(dni):
+    conn = conectar_journal()
+    try:
+        tipos = [t for (t,) in conn.execute(
+            "SELECT DISTINCT tipo FROM indice_resultados WHERE dni = ? ORDER BY tipo", (str(dni),))]
+        instituciones = [i for (i,) in conn.execute(
+            "SELECT DISTINCT institucion FROM indice_resultados WHERE dni = ? ORDER BY institucion", (str(dni),))]
+        return tipos, instituciones
+    finally:
+        conn.close()
+
+def obtener_filas_resultados(dni, entradas):
+    """Trae de Sheets solo las filas de la página (un único batch_get); si falla usa el snapshot.
+    Cada fila se verifica contra el índice (DNI y Archivo): si alguien borró u ordenó filas
+    en la hoja, la fila ya no es de este paciente y se descarta. Devuelve (filas, desajuste)."""
+    snapshot = leer_snapshot("Resultados") or []
+    filas = [fila for fila, _ in entradas]
+    try:
+        from gspread.utils import rowcol_to_a1
+
+        hoja = obtener_hoja("Resultados")
+        columnas = mapa_columnas(hoja, snapshot)
+        nombres = {idx: nombre for nombre, idx in columnas.items()}
+        ultima = max(columnas.values())
+        rangos = hoja.batch_get([f"{rowcol_to_a1(fila, 1)}:{rowcol_to_a1(fila, ultima)}" for fila in filas])
+        resultados = [{nombres[idx]: valor for idx, valor in enumerate(rango[0] if rango else [], start=1)
+                       if idx in nombres}
+                      for rango in rangos]
+    except Exception as e:
+        logger.warning("Error trayendo resultados de Sheets, se usa el snapshot: %s", e)
+        resultados = [snapshot[fila - 2] if 0 <= fila - 2 < len(snapshot) else {} for fila in filas]
+
+    verificados = [resultado for resultado, (_, archivo) in zip(resultados, entradas)
+                   if str(resultado.get('DNI', '')).strip() == str(dni).strip()
+                   and str(resultado.get('Archivo', '')) == archivo]
+    return verificados, len(verificados) != len(resultados)
+
+@st.cache_resource
+def obtener_cache_drive():
+    """Metadatos de archivos de Drive ya consultados (id -> (momento, metadatos), del menos
+    al más usado) e ids que se están consultando, compartidos entre sesiones"""
+    return {'metadatos': OrderedDict(), 'en_curso': set(), 'lock': threading.Lock()}
+
+def metadatos_drive(id_archivo):
+    """Metadatos en caché del archivo, o None si no están o vencieron"""
+    cache = obtener_cache_drive()
+    with cache['lock']:
+        entrada = cache['metadatos'].get(id_archivo)
+        if entrada is None:
+            return None
+        if time.time() - entrada[0] > VIGENCIA_METADATOS_DRIVE:
+            del cache['metadatos'][id_archivo]
+            return None
+        cache['metadatos'].move_to_end(id_archivo)
+        return entrada[1]
+
+def guardar_metadatos_drive(id_archivo, metadatos):
+    """Guarda los metadatos y descarta los menos usados si se pasa de MAX_METADATOS_DRIVE"""
+    cache = obtener_cache_drive()
+    with cache['lock']:
+        cache['metadatos'][id_archivo] = (time.time(), metadatos)
+        cache['metadatos'].move_to_end(id_archivo)
+        while len(cache['metadatos']) > MAX_METADATOS_DRIVE:
+            cache['metadatos'].popitem(last=False)
+
+def id_archivo_drive(enlace):
+    partes = str(enlace).split("/file/d/")
+    return partes[1].split("/")[0] if len(partes) > 1 else None
+
+def precargar_metadatos_drive(enlaces):
+    """Consulta en segundo plano los metadatos de Drive que todavía no están en caché.
+    Los ids quedan marcados como en curso antes de arrancar el hilo, así los reruns
+    siguientes no los vuelven a pedir mientras la consulta no termina."""
+    cache = obtener_cache_drive()
+    ids = [id_archivo for id_archivo in dict.fromkeys(map(id_archivo_drive, enlaces))
+           if id_archivo and metadatos_drive(id_archivo) is None]
+    if not ids:
+        return
+    credenciales = obtener_credenciales()
+    with cache['lock']:
+        ids = [id_archivo for id_archivo in ids if id_archivo not in cache['en_curso']]
+        cache['en_curso'].update(ids)
+    if not ids:
+        return
+
+    def precargar():
+        try:
+            servicio = crear_servicio_drive(credenciales)
+            for id_archivo in ids:
+                try:
+                    metadatos = servicio.files().get(
+                        fileId=id_archivo, fields="name,size,modifiedTime").execute()
+                except Exception as e:
+                    logger.warning("Error precargando metadatos de Drive (%s): %s", id_archivo, e)
+                    metadatos = {}
+                guardar_metadatos_drive(id_archivo, metadatos)
+        finally:
+            with cache['lock']:
+                cache['en_curso'].difference_update(ids)
+
+    threading.Thread(target=precargar, name="precarga_drive", daemon=True).start()
+
+def explorador_resultados(dni, clave):
+    """Muestra los resultados del DNI paginados y filtrables. Devuelve el total sin filtros."""
+    try:
+        sincronizar_indice_resultados()
     except Exception as e:
         st.error(f"Error al buscar resultados: {e}")
-        return []
+        return 0
+    total_paciente = contar_resultados_indice(dni)
+    if not total_paciente:
+        return 0
+
+    tipos, instituciones = opciones_filtro_resultados(dni)
+    col_tipo, col_institucion, col_cantidad = st.columns([2, 2, 1])
+    with col_tipo:
+        tipo = st.selectbox("Tipo de estudio", ["Todos"] + tipos, key=f"{clave}_tipo")
+    with col_institucion:
+        institucion = st.selectbox("Institución", ["Todas"] + instituciones, key=f"{clave}_institucion")
+    with col_cantidad:
+        por_pagina = st.selectbox("Por página", RESULTADOS_POR_PAGINA, key=f"{clave}_por_pagina")
+    tipo = None if tipo == "Todos" else tipo
+    institucion = None if institucion == "Todas" else institucion
+
+    for intento in range(2):
+        total = contar_resultados_indice(dni, tipo, institucion)
+        paginas = max(1, math.ceil(total / por_pagina))
+        pagina = min(st.session_state.get(f"{clave}_pagina", 1), paginas)
+
+        indice = pagina_resultados_indice(dni, tipo, institucion, por_pagina,
+                                          desde=(pagina - 1) * por_pagina)
+        resultados, desajuste = obtener_filas_resultados(dni, indice)
+        if not desajuste or intento:
+            break
+        # La hoja cambió (filas borradas u ordenadas): se reconstruye el índice y se reintenta
+        invalidar_indice_resultados()
+        try:
+            sincronizar_indice_resultados()
+        except Exception as e:
+            logger.warning("Error reconstruyendo el índice de resultados: %s", e)
+            break
+
+    siguiente = pagina_resultados_indice(dni, tipo, institucion, por_pagina, desde=pagina * por_pagina)
+    precargar_metadatos_drive([archivo for _, archivo in siguiente])
+
+    for resultado in resultados:
+        metadatos = metadatos_drive(id_archivo_drive(resultado.get('Archivo', ''))) or {}
+        nombre_archivo = metadatos.get('name', "Abrir PDF")
+        st.markdown(
+            f"**{resultado.get('Fecha_Estudio', '')}** · {resultado.get('Tipo_Estudio', '')} · "
+            f"{resultado.get('Institucion', '')}  \n"
+            f"👤 {resultado.get('Profesional', '')} · 📄 [{nombre_archivo}]({resultado.get('Archivo', '')})"
+        )
+        if resultado.get('Comentarios'):
+            st.caption(f"💬 {resultado['Comentarios']}")
+        st.divider()
+
+    col_anterior, col_pagina, col_siguiente = st.columns([1, 2, 1])
+    with col_anterior:
+        if st.button("← Anterior", key=f"{clave}_anterior", disabled=pagina <= 1):
+            st.session_state[f"{clave}_pagina"] = pagina - 1
+            st.rerun()
+    with col_pagina:
+        st.caption(f"Página {pagina} de {paginas} · {total} resultados")
+    with col_siguiente:
+        if st.button("Siguiente →", key=f"{clave}_siguiente", disabled=pagina >= paginas):
+            st.session_state[f"{clave}_pagina"] = pagina + 1
+            st.rerun()
+    return total_paciente
+
 def pagina_personal():
     st.header("📋 Página Personal del Día Preventivo")
+    iniciar_recalculo_recomendaciones()
     
     if st.button("← Volver al inicio"):
         st.session_state.paso_actual = 0
@@ -460,99 +1449,91 @@ def pagina_personal():
     if st.button("Buscar recomendaciones", type="primary"):
         if not dni.isdigit() or len(dni) != 8:
             st.error("DNI inválido. Debe tener 8 dígitos sin puntos.")
+            st.session_state.dni_personal = None
         else:
-            paciente = buscar_paciente_por_dni(dni)
-            if paciente:
-                # Obtener datos necesarios para las intervenciones
-                datos_personales = {
-                    'Sexo_Biologico': paciente.get('Sexo_Biologico', ''),
-                    'Nombre': paciente.get('Nombre', ''),
-                    'Apellido': paciente.get('Apellido', '')
-                }
-                
-                respuestas_medicas = {
-                    'edad': paciente.get('Edad', 0),
-                    'imc_val': float(paciente.get('IMC_val', 0)),
-                    'condiciones': {
-                        'hipertension': paciente.get('Hipertension', 'No'),
-                        'diabetes': paciente.get('Diabetes', 'No'),
-                        'colesterol': paciente.get('Colesterol', 'No'),
-                        'sedentarismo': paciente.get('Sedentarismo', 'No'),
-                        'tiempo_sentado': paciente.get('Tiempo_sentado', 'No'),
-                        'fumador': paciente.get('Fumador', 'No'),
-                        'fumador_20_anios': paciente.get('Fumador_20_anios', 'No'),
-                        'antecedentes_mama': paciente.get('Antecedentes_mama', 'No')
-                    }
-                }
-                
-                # Obtener intervenciones y mostrar recomendaciones
-                intervenciones = obtener_intervenciones(datos_personales, respuestas_medicas)
-                
-                st.markdown(f"""
-                ## {datos_personales['Nombre']}, estas son tus recomendaciones preventivas actualizadas 💡
-                *Basadas en tu último registro de {datetime.now().strftime('%d/%m/%Y')}*
-                """)
-                
-                # Mostrar recomendaciones en expansores
-                categorias = sorted(set([i['categoria'] for i in intervenciones]), 
-                                key=lambda x: ['Cáncer', 'Cardiovascular', 'Vacunas', 'Consejerías'].index(x) 
-                                if x in ['Cáncer', 'Cardiovascular', 'Vacunas', 'Consejerías'] else 4)
-                
-                for categoria in categorias:
-                    with st.expander(f"### {categoria} ({len([i for i in intervenciones if i['categoria'] == categoria])})", 
-                                expanded=True):
-                        for interv in [i for i in intervenciones if i['categoria'] == categoria]:
-                            with st.container():
-                                col1, col2 = st.columns([4, 1])
-                                with col1:
-                                    st.markdown(f"""
-                                    **{interv['nombre']}**  
-                                    🩺 {interv['explicacion'][:120]}...
-                                    """)
-                                with col2:
-                                    instituciones = obtener_instituciones(interv['tipo_estudio'])
-                                    if instituciones:
-                                        with st.popup("🏥 Centros disponibles"):
-                                            for inst in instituciones:
-                                                st.write(f"- {inst}")
-                                        st.button("Sacar turno", key=f"turno_{interv['nombre']}_{dni}")
-                                st.divider()
-                
-                # Tabla resumen (igual que en mostrar_recomendaciones)
-                if intervenciones:
-                    st.subheader("📋 Resumen completo")
-                    df = pd.DataFrame([{
-                        'Recomendación': i['nombre'],
-                        'Categoría': i['categoria'],
-                        'Acciones': f"[Más info](#) | [Sacar turno](#)"
-                    } for i in intervenciones])
-                    
-                    st.markdown(df.style.hide(axis="index").to_html(), unsafe_allow_html=True)
-                else:
-                    st.success("🎉 ¡Excelente! No hay recomendaciones urgentes en este momento")
-                
-                # Mostrar resultados igual que en profesionales
-                resultados = buscar_resultados_paciente(dni)
-                if resultados:
-                    st.subheader("📁 Tus resultados cargados")
-                    for resultado in resultados:
-                        st.write(f"**Fecha del estudio:** {resultado['fecha_estudio']}")
-                        st.write(f"**Tipo de estudio:** {resultado['tipo_estudio']}")
-                        st.write(f"**Institución:** {resultado['institucion']}")
-                        st.markdown(f"**Archivo:** [Abrir PDF]({resultado['archivo']})")
-                        if resultado['comentarios']:
-                            st.write(f"**Comentarios:** {resultado['comentarios']}")
-                        st.write("---")
-                else:
-                    st.info("ℹ️ No se encontraron resultados cargados para tu DNI")
+            st.session_state.dni_personal = dni
 
+    # El DNI buscado queda en sesión para que paginar los resultados no oculte la página
+    if st.session_state.get('dni_personal'):
+        dni = st.session_state.dni_personal
+        # Lectura directa de las recomendaciones ya calculadas para el DNI
+        registro = leer_recomendaciones(dni)
+        paciente = None if registro else buscar_paciente_por_dni(dni)
+        sin_reglas = False
+        if paciente:
+            # Paciente sin recomendaciones guardadas: se calculan una vez y se materializan
+            datos_personales, respuestas_medicas = perfil_desde_paciente(paciente)
+            if materializar_recomendaciones(dni, datos_personales, respuestas_medicas) is None:
+                sin_reglas = True
+            registro = leer_recomendaciones(dni)
+
+        if sin_reglas:
+            st.error("No se pudieron calcular las recomendaciones en este momento. Intente nuevamente en unos minutos.")
+        elif registro:
+            datos_personales = registro['datos_personales']
+            intervenciones = registro['intervenciones']
+            actualizado = datetime.fromisoformat(registro['actualizado'])
+            
+            st.markdown(f"""
+            ## {datos_personales['Nombre']}, estas son tus recomendaciones preventivas actualizadas 💡
+            *Basadas en tu último registro de {actualizado.strftime('%d/%m/%Y')}*
+            """)
+            
+            # Mostrar recomendaciones en expansores
+            categorias = sorted(set([i['categoria'] for i in intervenciones]), 
+                            key=lambda x: ['Cáncer', 'Cardiovascular', 'Vacunas', 'Consejerías'].index(x) 
+                            if x in ['Cáncer', 'Cardiovascular', 'Vacunas', 'Consejerías'] else 4)
+            
+            for categoria in categorias:
+                with st.expander(f"### {categoria} ({len([i for i in intervenciones if i['categoria'] == categoria])})", 
+                            expanded=True):
+                    for interv in [i for i in intervenciones if i['categoria'] == categoria]:
+                        with st.container():
+                            col1, col2 = st.columns([4, 1])
+                            with col1:
+                                st.markdown(f"""
+                                **{interv['nombre']}**  
+                                🩺 {interv['explicacion'][:120]}...
+                                """)
+                            with col2:
+                                instituciones = obtener_instituciones(interv['tipo_estudio'])
+                                if instituciones:
+                                    with st.popup("🏥 Centros disponibles"):
+                                        for inst in instituciones:
+                                            st.write(f"- {inst}")
+                                    st.button("Sacar turno", key=f"turno_{interv['nombre']}_{dni}")
+                            st.divider()
+            
+            # Tabla resumen (igual que en mostrar_recomendaciones)
+            if intervenciones:
+                st.subheader("📋 Resumen completo")
+                import pandas as pd
+                df = pd.DataFrame([{
+                    'Recomendación': i['nombre'],
+                    'Categoría': i['categoria'],
+                    'Acciones': f"[Más info](#) | [Sacar turno](#)"
+                } for i in intervenciones])
+                
+                st.markdown(df.style.hide(axis="index").to_html(), unsafe_allow_html=True)
             else:
-                st.error("No se encontró un registro con este DNI. ¿Ya completó su formulario preventivo?")
+                st.success("🎉 ¡Excelente! No hay recomendaciones urgentes en este momento")
+            
+            # Mostrar resultados igual que en profesionales
+            st.subheader("📁 Tus resultados cargados")
+            if not explorador_resultados(dni, f"resultados_personal_{dni}"):
+                st.info("ℹ️ No se encontraron resultados cargados para tu DNI")
+
+        else:
+            st.error("No se encontró un registro con este DNI. ¿Ya completó su formulario preventivo?")
 def main():
     if 'paso_actual' not in st.session_state:
         st.session_state.paso_actual = 0  # Cambiado a 0 para mostrar presentación inicial
         st.session_state.datos_personales = {}
         st.session_state.respuestas_medicas = {}
+
+    # El hilo del journal arranca una vez por proceso y reintenta lo que haya quedado
+    # pendiente; en cada rerun no se abre la base
+    iniciar_reproductor_journal()
     
     # Manejar los diferentes pasos
     if st.session_state.paso_actual == 0:
@@ -628,7 +1609,9 @@ def main():
                         'Telefono': telefono
                     }
                     try:
-                        sheet_pacientes.append_row(list(datos.values()))
+                        registrar_escritura("alta_paciente", dni, datos)
+                        avisar_reproductor_journal()
+                        actualizar_analitica(dni, paciente=datos)
                         st.session_state.datos_personales = datos
                         st.session_state.paso_actual = 2
                         st.rerun()
@@ -724,35 +1707,21 @@ def main():
                     }
                         
         # CORRECCIÓN 2: Todo este código DEBE estar DENTRO del if
+                    # Se guarda primero en el journal local y después se envía a Sheets,
+                    # así las respuestas no se pierden aunque la planilla no responda
                     dni = st.session_state.datos_personales['DNI']
-                    st.write(f"DEBUG - Buscando DNI: {dni}")  # Para verificar en consola
-                    row = find_dni_row(sheet_pacientes, dni)
-                    if not row:
-                        st.error("Error: Registro no encontrado. ¿Guardó correctamente el Paso 1?")
-                    else:
-                        st.write(f"DEBUG - Fila encontrada: {row}")  # Verificar fila correcta
-                        if update_record(sheet_pacientes, row, datos_medicos):
-                            st.session_state.paso_actual = 3
-                            st.rerun()
-                    
-                    # Dentro del bloque st.form_submit_button("Continuar →"):
-                    st.write("Datos a guardar:", datos_medicos)  # Debug visual
-                    row = find_dni_row(sheet_pacientes, dni)
-                if not row:
-                    st.error("Error: Registro no encontrado")
-                elif not update_record(sheet_pacientes, row, datos_medicos):
-                    st.error("Error técnico al guardar. Intente nuevamente o contacte soporte")
-        
-                    if row:
-                        if update_record(sheet_pacientes, row, datos_medicos):
-                            st.session_state.paso_actual = 3
-                            st.rerun()
+                    try:
+                        registrar_escritura("datos_medicos", dni, datos_medicos)
+                    except Exception as e:
+                        st.error(f"Error técnico al guardar. Intente nuevamente o contacte soporte: {e}")
                     else:
-                        st.error("Error al guardar datos médicos")
+                        avisar_reproductor_journal()
+                        actualizar_analitica(dni, paciente={**datos, **datos_medicos})
+                        materializar_recomendaciones(dni, datos, st.session_state.respuestas_medicas)
+                        st.session_state.paso_actual = 3
+                        st.rerun()
                 else:
-                    st.error("No se encontró el registro del paciente")
-            else:
-                st.error("Complete todos los campos obligatorios")
+                    st.error("Complete todos los campos obligatorios")
         # Paso 3: Recomendaciones personalizadas
     elif st.session_state.paso_actual == 3:
         if st.button("← Volver al cuestionario"):
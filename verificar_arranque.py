@@ -0,0 +1,72 @@
+"""Control del presupuesto de arranque de app.py, para correr en CI o antes de desplegar:
+
+    python verificar_arranque.py [presupuesto_en_segundos]
+
+Importa app en un proceso nuevo (con -X importtime) y falla si la importación tarda más
+que el presupuesto o si ya se importaron las dependencias que deben cargarse recién al
+usarlas. No corre dentro de la app: un pedido de un usuario nunca falla por esto.
+"""
+import json
+import os
+import subprocess
+import sys
+
+# Presupuesto por defecto en segundos; incluye importar streamlit
+PRESUPUESTO_CARGA_SEG = float(os.getenv("PRESUPUESTO_CARGA_SEG", "1.5"))
+MODULOS_DIFERIDOS = ("gspread", "googleapiclient", "google.oauth2.service_account", "pandas")
+# Módulos más lentos que se muestran cuando se excede el presupuesto
+MODULOS_A_MOSTRAR = 10
+
+PROGRAMA = """
+import json, sys, time
+inicio = time.perf_counter()
+import app
+print(json.dumps({
+    "segundos": time.perf_counter() - inicio,
+    "importados": [m for m in %r if m in sys.modules],
+}))
+""" % (MODULOS_DIFERIDOS,)
+
+def modulos_mas_lentos(salida_importtime):
+    """Módulos con mayor tiempo acumulado según la salida de -X importtime"""
+    tiempos = []
+    for linea in salida_importtime.splitlines():
+        if not linea.startswith("import time:") or "|" not in linea:
+            continue
+        _, acumulado, modulo = linea[len("import time:"):].split("|")
+        if acumulado.strip().isdigit():
+            tiempos.append((int(acumulado), modulo.strip()))
+    return sorted(tiempos, reverse=True)[:MODULOS_A_MOSTRAR]
+
+def main():
+    presupuesto = float(sys.argv[1]) if len(sys.argv) > 1 else PRESUPUESTO_CARGA_SEG
+    entorno = dict(os.environ)
+    # app.py lee la clave privada al importarse; para medir alcanza con un valor vacío
+    entorno.setdefault("PRIVATE_KEY", "")
+    proceso = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROGRAMA],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=entorno, capture_output=True, text=True
+    )
+    if proceso.returncode != 0:
+        print(proceso.stderr, file=sys.stderr)
+        print("No se pudo importar app.py", file=sys.stderr)
+        return 1
+
+    medicion = json.loads(proceso.stdout.strip().splitlines()[-1])
+    problemas = []
+    if medicion["segundos"] > presupuesto:
+        problemas.append(f"la carga del módulo tardó {medicion['segundos']:.2f}s (presupuesto {presupuesto:.2f}s)")
+    if medicion["importados"]:
+        problemas.append(f"se importaron al arrancar: {', '.join(medicion['importados'])}")
+
+    if not problemas:
+        print(f"Arranque dentro del presupuesto: {medicion['segundos']:.2f}s de {presupuesto:.2f}s")
+        return 0
+    print("Presupuesto de arranque excedido: " + "; ".join(problemas), file=sys.stderr)
+    for microsegundos, modulo in modulos_mas_lentos(proceso.stderr):
+        print(f"  {microsegundos / 1e6:8.3f}s  {modulo}", file=sys.stderr)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())